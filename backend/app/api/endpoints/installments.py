@@ -1,51 +1,51 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, Response
+from pydantic import TypeAdapter
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from datetime import datetime, timedelta
+from decimal import Decimal
 
 from ...database import get_db
-from ... import crud, schemas, models
+from ... import cache, crud, schemas, models
 from ...celery_tasks import schedule_installment_charge
 
 router = APIRouter()
 
+InstallmentList = TypeAdapter(List[schemas.InstallmentResponse])
+
+InstallmentOrderPage = schemas.PaginatedResponse[schemas.InstallmentOrderResponse]
+
 @router.post("/orders", response_model=schemas.InstallmentOrderResponse)
 def create_installment_order(
     order_data: schemas.InstallmentOrderCreate,
-    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db)
 ):
     """
     Create a new installment order with flexible payment schedule
     """
-    # Validate installment amount
+    # Validate installment amount; the last installment absorbs the rounding
+    # remainder, which must stay under a cent per installment
     if order_data.installment_amount:
-        total_calculated = order_data.installment_amount * order_data.installment_count
-        if abs(total_calculated - order_data.amount) > 0.01:  # Allow small rounding differences
+        remainder = order_data.amount - order_data.installment_amount * order_data.installment_count
+        if abs(remainder) >= Decimal("0.01") * order_data.installment_count:
             raise HTTPException(
                 status_code=400, 
                 detail="Installment amount * count must equal total amount"
             )
     
-    # Create the installment order
-    db_order = crud.create_installment_order(db, order_data)
-    
-    # Create installments for the order
-    installments = crud.create_installments_for_order(
-        db, 
-        db_order.id, 
-        db_order.installment_amount, 
-        db_order.installment_count
-    )
-    
-    # Schedule the first installment charge
-    if installments:
-        background_tasks.add_task(
-            schedule_installment_charge,
-            installment_id=installments[0].id,
-            due_date=installments[0].due_date.isoformat()
+    # Small amounts over many installments can round an installment down to
+    # zero or below, which could never be charged
+    installment_amount, last_amount = crud.installment_amounts(order_data)
+    if installment_amount <= 0 or last_amount <= 0:
+        raise HTTPException(
+            status_code=400,
+            detail="Every installment must be a positive amount"
         )
     
+    # Create the installment order together with its installments; the
+    # periodic drainer charges each one once it falls due
+    db_order = crud.create_installment_order(db, order_data)
+    
     return db_order
 
 @router.get("/orders/{order_id}", response_model=schemas.InstallmentOrderResponse)
@@ -53,12 +53,20 @@ def get_installment_order(order_id: str, db: Session = Depends(get_db)):
     """
     Get installment order details
     """
-    db_order = crud.get_installment_order(db, order_id)
-    if not db_order:
-        raise HTTPException(status_code=404, detail="Installment order not found")
-    return db_order
+    # Serve the serialized response from Redis while it is fresh; status
+    # updates invalidate the entry
+    cache_key = cache.installment_order_key(order_id)
+    body = cache.get(cache_key)
+    if body is None:
+        db_order = crud.get_installment_order(db, order_id)
+        if not db_order:
+            raise HTTPException(status_code=404, detail="Installment order not found")
+        body = schemas.InstallmentOrderResponse.model_validate(db_order).model_dump_json()
+        cache.set(cache_key, body)
+    
+    return Response(content=body, media_type="application/json")
 
-@router.get("/orders", response_model=List[schemas.InstallmentOrderResponse])
+@router.get("/orders", response_model=None, responses={200: {"model": InstallmentOrderPage}})
 def get_installment_orders(
     customer_id: Optional[str] = None,
     status: Optional[str] = None,
@@ -69,20 +77,20 @@ def get_installment_orders(
     """
     Get list of installment orders with optional filtering
     """
-    orders = crud.get_installment_orders(db, customer_id, status, skip, limit)
-    return orders
+    orders, total = crud.get_installment_orders(db, customer_id, status, skip, limit)
+    page = InstallmentOrderPage.from_page(orders, total, skip, limit)
+    return Response(content=page.model_dump_json(), media_type="application/json")
 
-@router.get("/orders/{order_id}/installments", response_model=List[schemas.InstallmentResponse])
+@router.get("/orders/{order_id}/installments", response_model=None, responses={200: {"model": List[schemas.InstallmentResponse]}})
 def get_order_installments(order_id: str, db: Session = Depends(get_db)):
     """
     Get all installments for a specific order
     """
-    db_order = crud.get_installment_order(db, order_id)
+    db_order = crud.get_order_with_installments(db, order_id)
     if not db_order:
         raise HTTPException(status_code=404, detail="Installment order not found")
     
-    installments = crud.get_installments_by_order(db, order_id)
-    return installments
+    return Response(content=schemas.dump_list(InstallmentList, db_order.installments), media_type="application/json")
 
 @router.post("/orders/{order_id}/activate")
 def activate_installment_order(order_id: str, db: Session = Depends(get_db)):
@@ -97,45 +105,43 @@ def activate_installment_order(order_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail="Order is not in pending status")
     
     updated_order = crud.update_installment_order_status(db, order_id, "active")
-    return {"message": "Installment order activated successfully", "order": updated_order}
+    return {
+        "message": "Installment order activated successfully",
+        "order": schemas.InstallmentOrderResponse.model_validate(updated_order)
+    }
 
-@router.get("/due-installments", response_model=List[schemas.InstallmentResponse])
+@router.get("/due-installments", response_model=None, responses={200: {"model": List[schemas.InstallmentResponse]}})
 def get_due_installments(db: Session = Depends(get_db)):
     """
     Get all installments that are due for payment
     """
     installments = crud.get_due_installments(db)
-    return installments
+    return Response(content=schemas.dump_list(InstallmentList, installments), media_type="application/json")
 
 @router.post("/installments/{installment_id}/process")
 def process_installment_payment(
     installment_id: str,
-    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db)
 ):
     """
     Process payment for a specific installment
     """
-    db_installment = crud.get_installments_by_order(db, installment_id)
+    db_installment = crud.get_installment(db, installment_id)
     if not db_installment:
         raise HTTPException(status_code=404, detail="Installment not found")
     
-    # This would typically trigger the charge creation and processing
-    # For now, we'll just update the status
-    updated_installment = crud.update_installment_status(db, installment_id, "processing")
+    if db_installment.status != "pending":
+        raise HTTPException(status_code=400, detail="Installment is not in pending status")
     
-    # Schedule the charge processing
-    background_tasks.add_task(
-        process_installment_charge,
-        installment_id=installment_id
+    # Hand the charge off to the worker, which claims the installment
+    schedule_installment_charge.apply_async(
+        kwargs={
+            "installment_id": installment_id,
+            "due_date": db_installment.due_date.isoformat()
+        }
     )
     
-    return {"message": "Installment payment processing started", "installment": updated_installment}
-
-def process_installment_charge(installment_id: str):
-    """
-    Background task to process installment charge
-    """
-    # This would be implemented in the Celery worker
-    # For now, it's a placeholder
-    pass
+    return {
+        "message": "Installment payment processing started",
+        "installment": schemas.InstallmentResponse.model_validate(db_installment)
+    }
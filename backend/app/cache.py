@@ -0,0 +1,65 @@
+import os
+import time
+from typing import Optional
+
+import redis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+CACHE_TTL = int(os.getenv("CACHE_TTL", "30"))
+
+# Seconds to stop trying Redis after a connection error, so an outage costs
+# one timeout per window instead of one per request
+RETRY_AFTER = 5.0
+
+redis_client = redis.Redis.from_url(
+    REDIS_URL,
+    socket_connect_timeout=0.5,
+    socket_timeout=0.5
+)
+
+_unavailable_until = 0.0
+
+def available() -> bool:
+    """
+    False while backing off after a connection error; other Redis users
+    (e.g. the worker's webhook breakers) share the same back-off
+    """
+    return time.monotonic() >= _unavailable_until
+
+def mark_unavailable():
+    global _unavailable_until
+    _unavailable_until = time.monotonic() + RETRY_AFTER
+
+def installment_order_key(order_id: str) -> str:
+    return f"io:{order_id}"
+
+def get(key: str) -> Optional[bytes]:
+    """
+    Return the cached value, or None on a miss or when Redis is unreachable
+    """
+    if not available():
+        return None
+    try:
+        return redis_client.get(key)
+    except redis.RedisError:
+        mark_unavailable()
+        return None
+
+def set(key: str, value: bytes, ttl: int = CACHE_TTL):
+    if not available():
+        return
+    try:
+        redis_client.set(key, value, ex=ttl)
+    except redis.RedisError:
+        mark_unavailable()
+
+def delete(key: str):
+    # Not gated on availability: a missed invalidation serves stale data
+    # until the TTL runs out, so always try
+    try:
+        redis_client.delete(key)
+    except redis.RedisError:
+        mark_unavailable()
@@ -0,0 +1,26 @@
+# Celery settings shared by the API's producer app (app/celery_tasks.py) and
+# the worker app (celery_worker.py), loaded by both with config_from_object
+# so the two cannot drift apart. Worker-only settings stay in celery_worker.py.
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+broker_url = os.getenv("CELERY_BROKER_URL", "redis://redis:6379/0")
+result_backend = os.getenv("CELERY_RESULT_BACKEND", "redis://redis:6379/0")
+
+task_serializer = "json"
+accept_content = ["json"]
+result_serializer = "json"
+timezone = "UTC"
+enable_utc = True
+
+# Keep a bounded pool of long-lived Redis connections instead of reconnecting
+# under heavy fan-out; keepalive and health checks drop dead sockets before a
+# publish hits them
+broker_pool_limit = int(os.getenv("CELERY_BROKER_POOL_LIMIT", "50"))
+broker_transport_options = {"socket_keepalive": True, "health_check_interval": 30}
+redis_max_connections = int(os.getenv("CELERY_REDIS_MAX_CONNECTIONS", "50"))
+redis_socket_keepalive = True
+result_backend_transport_options = {"retry_policy": {"timeout": 5.0}}
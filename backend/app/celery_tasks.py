@@ -1,16 +1,16 @@
-# This file contains Celery task imports and definitions
-# The actual tasks are defined in celery_worker.py
+# Producer-side Celery app for the API process.
+# The tasks themselves are defined in celery_worker.py; the API sends them by
+# name so it never imports the worker (Stripe, httpx, the task graph).
 
 from celery import Celery
 
 celery = Celery("ins_py_api")
-# celery.conf.update(...)
+celery.config_from_object("app.celery_config")
 
-from celery_worker import schedule_installment_charge, process_charge, send_webhook_event
+# Task signatures, bound once at import
+schedule_installment_charge = celery.signature("celery_worker.schedule_installment_charge")
 
 __all__ = [
     "celery",
-    "schedule_installment_charge",
-    "process_charge", 
-    "send_webhook_event"
-] 
\ No newline at end of file
+    "schedule_installment_charge"
+]
@@ -1,15 +1,44 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_, desc
-from typing import List, Optional, Dict, Any
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy import and_, or_, desc, exists, func, insert, select, tuple_, update
+from sqlalchemy.sql import Select
+from typing import List, Optional, Dict, Any, Tuple
 from datetime import datetime, timedelta
-from . import models, schemas
-import uuid
+from decimal import Decimal
+from . import cache, models, schemas
+
+def paginate(db: Session, stmt: Select, skip: int, limit: int) -> Tuple[List[Any], int]:
+    """
+    Fetch one page of an entity select together with the total row count.
+
+    The count rides along as COUNT(*) OVER () so page and total come back in
+    a single query; only an empty page past the end, or of size zero, needs
+    a separate COUNT.
+    """
+    rows = db.execute(
+        stmt.add_columns(func.count().over()).offset(skip).limit(limit)
+    ).all()
+    if rows:
+        return [row[0] for row in rows], rows[0][1]
+    if skip or limit < 1:
+        total = db.scalar(select(func.count()).select_from(stmt.order_by(None).subquery()))
+        return [], total
+    return [], 0
 
 # Installment Order CRUD
+def installment_amounts(order_data: schemas.InstallmentOrderCreate) -> Tuple[Decimal, Decimal]:
+    """
+    Regular and last installment amounts; the last one takes the rounding
+    remainder so the installments add up to the order amount exactly
+    """
+    installment_amount = order_data.installment_amount or (
+        order_data.amount / order_data.installment_count
+    ).quantize(Decimal("0.01"))
+    last_amount = order_data.amount - installment_amount * (order_data.installment_count - 1)
+    return installment_amount, last_amount
+
 def create_installment_order(db: Session, order_data: schemas.InstallmentOrderCreate) -> models.InstallmentOrder:
     # Calculate installment amount if not provided
-    if not order_data.installment_amount:
-        order_data.installment_amount = order_data.amount / order_data.installment_count
+    order_data.installment_amount, last_amount = installment_amounts(order_data)
     
     db_order = models.InstallmentOrder(
         customer_id=order_data.customer_id,
@@ -19,6 +48,24 @@ def create_installment_order(db: Session, order_data: schemas.InstallmentOrderCr
         installment_amount=order_data.installment_amount
     )
     db.add(db_order)
+    db.flush()
+    
+    # Monthly installments, inserted with the order in one transaction using
+    # a single multi-row INSERT
+    count = db_order.installment_count
+    now = datetime.utcnow()
+    db.execute(
+        insert(models.Installment),
+        [
+            {
+                "order_id": db_order.id,
+                "installment_number": i,
+                "amount": last_amount if i == count else order_data.installment_amount,
+                "due_date": now + timedelta(days=30 * i)
+            }
+            for i in range(1, count + 1)
+        ]
+    )
     db.commit()
     db.refresh(db_order)
     return db_order
@@ -26,52 +73,44 @@ def create_installment_order(db: Session, order_data: schemas.InstallmentOrderCr
 def get_installment_order(db: Session, order_id: str) -> Optional[models.InstallmentOrder]:
     return db.query(models.InstallmentOrder).filter(models.InstallmentOrder.id == order_id).first()
 
+def get_order_with_installments(db: Session, order_id: str) -> Optional[models.InstallmentOrder]:
+    # Order and its installments in one round trip
+    return db.execute(
+        select(models.InstallmentOrder)
+        .options(joinedload(models.InstallmentOrder.installments))
+        .where(models.InstallmentOrder.id == order_id)
+    ).unique().scalar_one_or_none()
+
 def get_installment_orders(
     db: Session, 
     customer_id: Optional[str] = None, 
     status: Optional[str] = None,
     skip: int = 0, 
     limit: int = 100
-) -> List[models.InstallmentOrder]:
-    query = db.query(models.InstallmentOrder)
+) -> Tuple[List[models.InstallmentOrder], int]:
+    stmt = select(models.InstallmentOrder)
     
     if customer_id:
-        query = query.filter(models.InstallmentOrder.customer_id == customer_id)
+        stmt = stmt.where(models.InstallmentOrder.customer_id == customer_id)
     if status:
-        query = query.filter(models.InstallmentOrder.status == status)
+        stmt = stmt.where(models.InstallmentOrder.status == status)
     
-    return query.offset(skip).limit(limit).all()
+    return paginate(db, stmt, skip, limit)
 
 def update_installment_order_status(db: Session, order_id: str, status: str) -> Optional[models.InstallmentOrder]:
-    db_order = get_installment_order(db, order_id)
-    if db_order:
-        db_order.status = status
-        db.commit()
-        db.refresh(db_order)
+    db_order = db.execute(
+        update(models.InstallmentOrder)
+        .where(models.InstallmentOrder.id == order_id)
+        .values(status=status)
+        .returning(models.InstallmentOrder)
+    ).scalar_one_or_none()
+    db.commit()
+    cache.delete(cache.installment_order_key(order_id))
     return db_order
 
 # Installment CRUD
-def create_installments_for_order(db: Session, order_id: str, installment_amount: float, count: int) -> List[models.Installment]:
-    installments = []
-    for i in range(1, count + 1):
-        # Calculate due date (monthly installments)
-        due_date = datetime.utcnow() + timedelta(days=30 * i)
-        
-        installment = models.Installment(
-            order_id=order_id,
-            installment_number=i,
-            amount=installment_amount,
-            due_date=due_date
-        )
-        installments.append(installment)
-    
-    db.add_all(installments)
-    db.commit()
-    
-    for installment in installments:
-        db.refresh(installment)
-    
-    return installments
+def get_installment(db: Session, installment_id: str) -> Optional[models.Installment]:
+    return db.query(models.Installment).filter(models.Installment.id == installment_id).first()
 
 def get_installments_by_order(db: Session, order_id: str) -> List[models.Installment]:
     return db.query(models.Installment).filter(models.Installment.order_id == order_id).all()
@@ -84,14 +123,97 @@ def get_due_installments(db: Session) -> List[models.Installment]:
         )
     ).all()
 
+def has_due_installments(db: Session) -> bool:
+    # Index-only EXISTS probe, far cheaper than a locking claim when nothing is due
+    return db.scalar(
+        select(
+            exists().where(
+                models.Installment.status == "pending",
+                models.Installment.due_date <= datetime.utcnow()
+            )
+        )
+    )
+
+def claim_due_installments(db: Session, limit: int = 500) -> List[str]:
+    """
+    Claim up to `limit` due installments and create a pending charge for each.
+
+    Rows are selected FOR UPDATE SKIP LOCKED, so concurrent drainers each get
+    a disjoint batch. Marking them processing and inserting their charges
+    commit together, so a failure cannot leave an installment claimed without
+    a charge. Installments without a positive amount cannot be charged; they
+    are marked failed instead, so one bad row cannot stall every batch.
+    Returns the new charge ids.
+    """
+    installments = db.scalars(
+        select(models.Installment)
+        .options(selectinload(models.Installment.order))
+        .where(
+            models.Installment.status == "pending",
+            models.Installment.due_date <= datetime.utcnow()
+        )
+        .order_by(models.Installment.due_date)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).all()
+    
+    chargeable = [i for i in installments if i.amount > 0]
+    unchargeable = [i.id for i in installments if i.amount <= 0]
+    
+    charge_ids = []
+    if unchargeable:
+        db.execute(
+            update(models.Installment)
+            .where(models.Installment.id.in_(unchargeable))
+            .values(status="failed")
+        )
+    if chargeable:
+        db.execute(
+            update(models.Installment)
+            .where(models.Installment.id.in_([i.id for i in chargeable]))
+            .values(status="processing")
+        )
+        charge_ids = _insert_charges(db, [_installment_charge(i) for i in chargeable])
+    db.commit()
+    return charge_ids
+
 def update_installment_status(db: Session, installment_id: str, status: str) -> Optional[models.Installment]:
-    db_installment = db.query(models.Installment).filter(models.Installment.id == installment_id).first()
-    if db_installment:
-        db_installment.status = status
-        db.commit()
-        db.refresh(db_installment)
+    db_installment = db.execute(
+        update(models.Installment)
+        .where(models.Installment.id == installment_id)
+        .values(status=status)
+        .returning(models.Installment)
+    ).scalar_one_or_none()
+    db.commit()
     return db_installment
 
+def claim_installment(db: Session, installment_id: str) -> Optional[str]:
+    """
+    Atomically move a pending installment to processing and create its charge.
+
+    Returns the new charge id, or None if the installment does not exist or
+    was already claimed, so duplicate deliveries of the same charge task
+    cannot charge it twice. An installment without a positive amount is
+    marked failed and also returns None.
+    """
+    db_installment = db.execute(
+        update(models.Installment)
+        .where(models.Installment.id == installment_id, models.Installment.status == "pending")
+        .values(status="processing")
+        .returning(models.Installment)
+    ).scalar_one_or_none()
+    if not db_installment:
+        db.rollback()
+        return None
+    if db_installment.amount <= 0:
+        db_installment.status = "failed"
+        db.commit()
+        return None
+    
+    charge_id = _insert_charges(db, [_installment_charge(db_installment)])[0]
+    db.commit()
+    return charge_id
+
 # Wallet CRUD
 def create_wallet(db: Session, wallet_data: schemas.WalletCreate) -> models.Wallet:
     db_wallet = models.Wallet(
@@ -109,48 +231,64 @@ def get_wallet(db: Session, customer_id: str) -> Optional[models.Wallet]:
 def get_wallet_by_id(db: Session, wallet_id: str) -> Optional[models.Wallet]:
     return db.query(models.Wallet).filter(models.Wallet.id == wallet_id).first()
 
-def update_wallet_balance(db: Session, wallet_id: str, amount: float, transaction_type: str, 
-                         description: str = None, reference_id: str = None) -> Optional[models.Wallet]:
-    db_wallet = get_wallet_by_id(db, wallet_id)
-    if not db_wallet:
-        return None
+def update_wallet_balance(db: Session, wallet_id: str, amount: Decimal, transaction_type: str, 
+                         description: str = None, reference_id: str = None, commit: bool = True) -> Optional[models.Wallet]:
+    # Apply the delta in one conditional UPDATE so concurrent debits cannot
+    # overdraw the wallet or lose each other's writes
+    delta = amount if transaction_type == "credit" else -amount
     
-    balance_before = db_wallet.balance
+    stmt = update(models.Wallet).where(models.Wallet.id == wallet_id)
+    if transaction_type == "debit":
+        stmt = stmt.where(models.Wallet.balance >= amount)
     
-    if transaction_type == "credit":
-        db_wallet.balance += amount
-    elif transaction_type == "debit":
-        if db_wallet.balance < amount:
-            return None  # Insufficient funds
-        db_wallet.balance -= amount
+    db_wallet = db.execute(
+        stmt.values(balance=models.Wallet.balance + delta).returning(models.Wallet)
+    ).scalar_one_or_none()
+    if not db_wallet:
+        return None  # Wallet not found or insufficient funds
     
-    # Create ledger entry
+    # Create ledger entry in the same transaction
     ledger_entry = models.WalletLedger(
         wallet_id=wallet_id,
         transaction_type=transaction_type,
         amount=amount,
         description=description,
         reference_id=reference_id,
-        balance_before=balance_before,
+        balance_before=db_wallet.balance - delta,
         balance_after=db_wallet.balance
     )
     
     db.add(ledger_entry)
-    db.commit()
-    db.refresh(db_wallet)
+    if commit:
+        db.commit()
     return db_wallet
 
-def get_wallet_ledger(db: Session, wallet_id: str, skip: int = 0, limit: int = 100) -> List[models.WalletLedger]:
-    return db.query(models.WalletLedger).filter(
+def get_wallet_ledger(db: Session, wallet_id: str, before: Optional[datetime] = None,
+                      before_id: Optional[str] = None, limit: int = 100) -> List[models.WalletLedger]:
+    # Keyset pagination: continue from the oldest entry of the previous page
+    # instead of skipping rows with OFFSET. Entries written in one transaction
+    # share created_at, so the id breaks ties.
+    query = db.query(models.WalletLedger).filter(
         models.WalletLedger.wallet_id == wallet_id
-    ).order_by(desc(models.WalletLedger.created_at)).offset(skip).limit(limit).all()
+    )
+    if before and before_id:
+        query = query.filter(
+            tuple_(models.WalletLedger.created_at, models.WalletLedger.id) < tuple_(before, before_id)
+        )
+    elif before:
+        query = query.filter(models.WalletLedger.created_at < before)
+    
+    return query.order_by(
+        desc(models.WalletLedger.created_at), desc(models.WalletLedger.id)
+    ).limit(limit).all()
 
 # Charge CRUD
 def create_charge(db: Session, charge_data: schemas.ChargeCreate) -> models.Charge:
+    # Charge currencies are stored lower-case, the form Stripe expects
     db_charge = models.Charge(
         customer_id=charge_data.customer_id,
         amount=charge_data.amount,
-        currency=charge_data.currency,
+        currency=charge_data.currency.lower(),
         installment_id=charge_data.installment_id,
         installment_order_id=charge_data.installment_order_id,
         split_instructions=charge_data.split_instructions
@@ -160,42 +298,137 @@ def create_charge(db: Session, charge_data: schemas.ChargeCreate) -> models.Char
     db.refresh(db_charge)
     return db_charge
 
+def _installment_charge(installment: models.Installment) -> schemas.ChargeCreate:
+    return schemas.ChargeCreate(
+        customer_id=installment.order.customer_id,
+        amount=installment.amount,
+        currency=installment.order.currency,
+        installment_id=installment.id,
+        installment_order_id=installment.order_id
+    )
+
+def _insert_charges(db: Session, charges_data: List[schemas.ChargeCreate]) -> List[str]:
+    # One multi-row INSERT ... RETURNING; ids come back in input order
+    rows = [charge_data.model_dump() for charge_data in charges_data]
+    for row in rows:
+        row["currency"] = row["currency"].lower()
+    
+    return db.scalars(
+        insert(models.Charge).returning(models.Charge.id, sort_by_parameter_order=True),
+        rows
+    ).all()
+
 def get_charge(db: Session, charge_id: str) -> Optional[models.Charge]:
     return db.query(models.Charge).filter(models.Charge.id == charge_id).first()
 
 def update_charge_status(db: Session, charge_id: str, status: str, 
                         payment_method: str = None, external_charge_id: str = None) -> Optional[models.Charge]:
-    db_charge = get_charge(db, charge_id)
-    if db_charge:
-        db_charge.status = status
-        if payment_method:
-            db_charge.payment_method = payment_method
-        if external_charge_id:
-            db_charge.external_charge_id = external_charge_id
-        db.commit()
-        db.refresh(db_charge)
+    changes = {"status": status}
+    if payment_method:
+        changes["payment_method"] = payment_method
+    if external_charge_id:
+        changes["external_charge_id"] = external_charge_id
+    
+    db_charge = db.execute(
+        update(models.Charge)
+        .where(models.Charge.id == charge_id)
+        .values(**changes)
+        .returning(models.Charge)
+    ).scalar_one_or_none()
+    db.commit()
     return db_charge
 
+# Installment status that follows from its charge's outcome
+INSTALLMENT_STATUS_FOR_CHARGE = {"succeeded": "paid", "needs_review": "needs_review"}
+
+def settle_charge(db: Session, charge_id: str, status: str,
+                  payment_method: str = None, external_charge_id: str = None) -> Optional[models.Charge]:
+    """
+    Record a charge's outcome and move its installment, if any, to paid,
+    failed or needs_review in the same transaction
+    """
+    changes = {"status": status}
+    if payment_method:
+        changes["payment_method"] = payment_method
+    if external_charge_id:
+        changes["external_charge_id"] = external_charge_id
+    
+    db_charge = db.execute(
+        update(models.Charge)
+        .where(models.Charge.id == charge_id)
+        .values(**changes)
+        .returning(models.Charge)
+    ).scalar_one_or_none()
+    if db_charge and db_charge.installment_id:
+        db.execute(
+            update(models.Installment)
+            .where(models.Installment.id == db_charge.installment_id)
+            .values(status=INSTALLMENT_STATUS_FOR_CHARGE.get(status, "failed"))
+        )
+    db.commit()
+    return db_charge
+
+def claim_charge(db: Session, charge_id: str) -> Optional[models.Charge]:
+    """
+    Atomically move a pending charge to processing.
+
+    Returns None if the charge does not exist or was already claimed, so a
+    retried or redelivered charge task never takes the payment twice.
+    """
+    db_charge = db.execute(
+        update(models.Charge)
+        .where(models.Charge.id == charge_id, models.Charge.status == "pending")
+        .values(status="processing")
+        .returning(models.Charge)
+    ).scalar_one_or_none()
+    db.commit()
+    return db_charge
+
+def release_charge(db: Session, charge_id: str):
+    # Hand a claimed charge back for another attempt; only valid while no
+    # money has moved for it
+    db.execute(
+        update(models.Charge)
+        .where(models.Charge.id == charge_id, models.Charge.status == "processing")
+        .values(status="pending")
+    )
+    db.commit()
+
+def pay_charge_from_wallet(db: Session, charge_id: str, wallet_id: str, amount: Decimal) -> Optional[models.Charge]:
+    """
+    Debit the whole charge from the wallet and settle it in one transaction.
+
+    Returns None, changing nothing, if the wallet no longer covers it.
+    """
+    if not update_wallet_balance(
+        db, wallet_id, amount, "debit",
+        f"Payment for charge {charge_id}", charge_id, commit=False
+    ):
+        db.rollback()
+        return None
+    return settle_charge(db, charge_id, "succeeded", "wallet")
+
 def get_charges(
     db: Session, 
     customer_id: Optional[str] = None,
     status: Optional[str] = None,
     skip: int = 0, 
     limit: int = 100
-) -> List[models.Charge]:
-    query = db.query(models.Charge)
+) -> Tuple[List[models.Charge], int]:
+    stmt = select(models.Charge)
     
     if customer_id:
-        query = query.filter(models.Charge.customer_id == customer_id)
+        stmt = stmt.where(models.Charge.customer_id == customer_id)
     if status:
-        query = query.filter(models.Charge.status == status)
+        stmt = stmt.where(models.Charge.status == status)
     
-    return query.order_by(desc(models.Charge.created_at)).offset(skip).limit(limit).all()
+    return paginate(db, stmt.order_by(desc(models.Charge.created_at)), skip, limit)
 
 # Webhook Log CRUD
 def create_webhook_log(db: Session, event_type: str, payload: Dict[str, Any]) -> models.WebhookLog:
     db_webhook = models.WebhookLog(
         event_type=event_type,
+        charge_id=payload.get("charge_id"),
         payload=payload
     )
     db.add(db_webhook)
@@ -203,19 +436,34 @@ def create_webhook_log(db: Session, event_type: str, payload: Dict[str, Any]) ->
     db.refresh(db_webhook)
     return db_webhook
 
+def get_logged_webhook_events(db: Session, charge_ids: List[str]) -> set:
+    """
+    (charge_id, event_type) pairs that already have a webhook log
+    """
+    if not charge_ids:
+        return set()
+    rows = db.execute(
+        select(models.WebhookLog.charge_id, models.WebhookLog.event_type)
+        .where(models.WebhookLog.charge_id.in_(charge_ids))
+    ).all()
+    return set(map(tuple, rows))
+
 def update_webhook_log_status(db: Session, webhook_id: str, status: str, error_message: str = None) -> Optional[models.WebhookLog]:
-    db_webhook = db.query(models.WebhookLog).filter(models.WebhookLog.id == webhook_id).first()
-    if db_webhook:
-        db_webhook.status = status
-        if status == "processed":
-            db_webhook.processed_at = datetime.utcnow()
-        if error_message:
-            db_webhook.error_message = error_message
-        db.commit()
-        db.refresh(db_webhook)
+    changes = {"status": status}
+    if status == "processed":
+        changes["processed_at"] = datetime.utcnow()
+    if error_message:
+        changes["error_message"] = error_message
+    
+    db_webhook = db.execute(
+        update(models.WebhookLog)
+        .where(models.WebhookLog.id == webhook_id)
+        .values(**changes)
+        .returning(models.WebhookLog)
+    ).scalar_one_or_none()
+    db.commit()
     return db_webhook
 
-def get_webhook_logs(db: Session, skip: int = 0, limit: int = 100) -> List[models.WebhookLog]:
-    return db.query(models.WebhookLog).order_by(
-        desc(models.WebhookLog.created_at)
-    ).offset(skip).limit(limit).all()
+def get_webhook_logs(db: Session, skip: int = 0, limit: int = 100) -> Tuple[List[models.WebhookLog], int]:
+    stmt = select(models.WebhookLog).order_by(desc(models.WebhookLog.created_at))
+    return paginate(db, stmt, skip, limit)
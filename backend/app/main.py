@@ -1,41 +1,77 @@
-from fastapi import FastAPI, Depends, HTTPException
+import os
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from anyio import to_thread
+from pydantic import TypeAdapter
 from sqlalchemy.orm import Session
 from typing import List, Optional
+from datetime import datetime
+from decimal import Decimal
 
-from .database import engine, get_db
+from .database import engine, get_db, DB_POOL_SIZE, DB_MAX_OVERFLOW
 from . import models, schemas, crud
 from .api.endpoints import installments
 
 # Create database tables
 models.Base.metadata.create_all(bind=engine)
 
+# Sync endpoints run in AnyIO's threadpool, 40 threads by default. Sessions
+# only take a connection on their first query, so requests served from the
+# Redis cache never hold one; size the threadpool above the connection pool
+# so those requests are not queued behind database-bound ones.
+API_THREADPOOL_SIZE = max(
+    int(os.getenv("API_THREADPOOL_SIZE", "100")), DB_POOL_SIZE + DB_MAX_OVERFLOW
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    to_thread.current_default_thread_limiter().total_tokens = API_THREADPOOL_SIZE
+    yield
+
 app = FastAPI(
     title="Payments API",
     description="A comprehensive payments API with installment orders, wallet management, and webhook handling",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
-# CORS middleware
+# CORS middleware; explicit lists avoid wildcard matching on every request and
+# max_age lets browsers cache preflights for a day
+CORS_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("CORS_ORIGINS", "http://localhost:3000").split(",")
+    if origin.strip()
+]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Configure appropriately for production
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,
 )
 
 # Include routers
 app.include_router(installments.router, prefix="/installments", tags=["installments"])
 
+WalletList = TypeAdapter(List[schemas.WalletResponse])
+WalletLedgerList = TypeAdapter(List[schemas.WalletLedgerResponse])
+
+ChargePage = schemas.PaginatedResponse[schemas.ChargeResponse]
+WebhookLogPage = schemas.PaginatedResponse[schemas.WebhookLogResponse]
+
 # Wallet endpoints
-@app.get("/wallets", response_model=List[schemas.WalletResponse])
+@app.get("/wallets", response_model=None, responses={200: {"model": List[schemas.WalletResponse]}})
 def get_wallets(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
     """
     Get a list of all wallets.
     """
     wallets = db.query(models.Wallet).offset(skip).limit(limit).all()
-    return wallets
+    return Response(content=schemas.dump_list(WalletList, wallets), media_type="application/json")
 @app.post("/wallets", response_model=schemas.WalletResponse)
 def create_wallet(wallet_data: schemas.WalletCreate, db: Session = Depends(get_db)):
     """
@@ -58,27 +94,30 @@ def get_wallet(customer_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Wallet not found")
     return wallet
 
-@app.get("/wallets/{customer_id}/ledger", response_model=List[schemas.WalletLedgerResponse])
+@app.get("/wallets/{customer_id}/ledger", response_model=None, responses={200: {"model": List[schemas.WalletLedgerResponse]}})
 def get_wallet_ledger(
     customer_id: str, 
-    skip: int = 0, 
+    before: Optional[datetime] = None, 
+    before_id: Optional[str] = None, 
     limit: int = 100, 
     db: Session = Depends(get_db)
 ):
     """
-    Get wallet transaction ledger
+    Get wallet transaction ledger, newest first.
+    Pass the created_at and id of the last entry as `before` and `before_id`
+    to fetch the next page.
     """
     wallet = crud.get_wallet(db, customer_id)
     if not wallet:
         raise HTTPException(status_code=404, detail="Wallet not found")
     
-    ledger = crud.get_wallet_ledger(db, str(wallet.id), skip, limit)
-    return ledger
+    ledger = crud.get_wallet_ledger(db, str(wallet.id), before, before_id, limit)
+    return Response(content=schemas.dump_list(WalletLedgerList, ledger), media_type="application/json")
 
 @app.post("/wallets/{customer_id}/credit")
 def credit_wallet(
     customer_id: str, 
-    amount: float, 
+    amount: Decimal, 
     description: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
@@ -123,7 +162,7 @@ def get_charge(charge_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Charge not found")
     return charge
 
-@app.get("/charges", response_model=List[schemas.ChargeResponse])
+@app.get("/charges", response_model=None, responses={200: {"model": ChargePage}})
 def get_charges(
     customer_id: Optional[str] = None,
     status: Optional[str] = None,
@@ -134,11 +173,12 @@ def get_charges(
     """
     Get list of charges with optional filtering
     """
-    charges = crud.get_charges(db, customer_id, status, skip, limit)
-    return charges
+    charges, total = crud.get_charges(db, customer_id, status, skip, limit)
+    page = ChargePage.from_page(charges, total, skip, limit)
+    return Response(content=page.model_dump_json(), media_type="application/json")
 
 # Webhook endpoints
-@app.get("/webhooks", response_model=List[schemas.WebhookLogResponse])
+@app.get("/webhooks", response_model=None, responses={200: {"model": WebhookLogPage}})
 def get_webhook_logs(
     skip: int = 0,
     limit: int = 100,
@@ -147,8 +187,9 @@ def get_webhook_logs(
     """
     Get webhook logs
     """
-    logs = crud.get_webhook_logs(db, skip, limit)
-    return logs
+    logs, total = crud.get_webhook_logs(db, skip, limit)
+    page = WebhookLogPage.from_page(logs, total, skip, limit)
+    return Response(content=page.model_dump_json(), media_type="application/json")
 
 @app.get("/webhooks/{webhook_id}", response_model=schemas.WebhookLogResponse)
 def get_webhook_log(webhook_id: str, db: Session = Depends(get_db)):
@@ -162,7 +203,7 @@ def get_webhook_log(webhook_id: str, db: Session = Depends(get_db)):
 
 # Health check
 @app.get("/health")
-def health_check():
+async def health_check():
     """
     Health check endpoint
     """
@@ -170,7 +211,7 @@ def health_check():
 
 # Root endpoint
 @app.get("/")
-def root():
+async def root():
     """
     Root endpoint with API information
     """
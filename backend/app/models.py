@@ -1,38 +1,50 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, Text, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, Numeric, DateTime, Boolean, Text, ForeignKey, JSON, Index
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
+from sqlalchemy.sql.expression import FunctionElement
 from .database import Base
-import uuid
 
-def generate_uuid():
-    return str(uuid.uuid4())
+class gen_random_uuid(FunctionElement):
+    """Server-side UUID primary key default, so inserts never call into Python per row."""
+    type = String()
+    inherit_cache = True
+
+@compiles(gen_random_uuid, "postgresql")
+def _pg_gen_random_uuid(element, compiler, **kw):
+    # Built into PostgreSQL 13+, no pgcrypto needed
+    return "gen_random_uuid()::text"
+
+@compiles(gen_random_uuid, "sqlite")
+def _sqlite_gen_random_uuid(element, compiler, **kw):
+    return "lower(hex(randomblob(16)))"
 
 class InstallmentOrder(Base):
     __tablename__ = "installment_orders"
     
-    id = Column(String, primary_key=True, default=generate_uuid)
+    id = Column(String, primary_key=True, server_default=gen_random_uuid())
     customer_id = Column(String, nullable=False)
-    amount = Column(Float, nullable=False)
+    amount = Column(Numeric(18, 2), nullable=False)
     currency = Column(String, default="USD")
     installment_count = Column(Integer, nullable=False)
-    installment_amount = Column(Float, nullable=False)
+    installment_amount = Column(Numeric(18, 2), nullable=False)
     status = Column(String, default="pending")  # pending, active, completed, failed
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
     # Relationships
-    installments = relationship("Installment", back_populates="order")
+    installments = relationship("Installment", back_populates="order", order_by="Installment.installment_number")
     charges = relationship("Charge", back_populates="installment_order")
 
 class Installment(Base):
     __tablename__ = "installments"
     
-    id = Column(String, primary_key=True, default=generate_uuid)
+    id = Column(String, primary_key=True, server_default=gen_random_uuid())
     order_id = Column(String, ForeignKey("installment_orders.id"), nullable=False)
     installment_number = Column(Integer, nullable=False)
-    amount = Column(Float, nullable=False)
+    amount = Column(Numeric(18, 2), nullable=False)
     due_date = Column(DateTime(timezone=True), nullable=False)
-    status = Column(String, default="pending")  # pending, paid, failed, overdue
+    status = Column(String, default="pending")  # pending, processing, paid, failed, needs_review, overdue
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
@@ -40,12 +52,17 @@ class Installment(Base):
     order = relationship("InstallmentOrder", back_populates="installments")
     charges = relationship("Charge", back_populates="installment")
 
+    __table_args__ = (
+        Index("ix_installments_status_due", "status", "due_date"),
+        Index("ix_installments_order_id", "order_id"),
+    )
+
 class Wallet(Base):
     __tablename__ = "wallets"
     
-    id = Column(String, primary_key=True, default=generate_uuid)
+    id = Column(String, primary_key=True, server_default=gen_random_uuid())
     customer_id = Column(String, nullable=False, unique=True)
-    balance = Column(Float, default=0.0)
+    balance = Column(Numeric(18, 2), default=0)
     currency = Column(String, default="USD")
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -57,27 +74,31 @@ class Wallet(Base):
 class WalletLedger(Base):
     __tablename__ = "wallet_ledger"
     
-    id = Column(String, primary_key=True, default=generate_uuid)
+    id = Column(String, primary_key=True, server_default=gen_random_uuid())
     wallet_id = Column(String, ForeignKey("wallets.id"), nullable=False)
     transaction_type = Column(String, nullable=False)  # credit, debit
-    amount = Column(Float, nullable=False)
+    amount = Column(Numeric(18, 2), nullable=False)
     description = Column(Text)
     reference_id = Column(String)  # charge_id or other reference
-    balance_before = Column(Float, nullable=False)
-    balance_after = Column(Float, nullable=False)
+    balance_before = Column(Numeric(18, 2), nullable=False)
+    balance_after = Column(Numeric(18, 2), nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relationships
     wallet = relationship("Wallet", back_populates="ledger_entries")
 
+    __table_args__ = (
+        Index("ix_wallet_ledger_wallet_created", wallet_id, created_at.desc()),
+    )
+
 class Charge(Base):
     __tablename__ = "charges"
     
-    id = Column(String, primary_key=True, default=generate_uuid)
+    id = Column(String, primary_key=True, server_default=gen_random_uuid())
     customer_id = Column(String, nullable=False)
-    amount = Column(Float, nullable=False)
+    amount = Column(Numeric(18, 2), nullable=False)
     currency = Column(String, default="USD")
-    status = Column(String, default="pending")  # pending, succeeded, failed
+    status = Column(String, default="pending")  # pending, processing, succeeded, failed, needs_review
     payment_method = Column(String)  # wallet, external
     external_charge_id = Column(String)  # Stripe charge ID
     installment_id = Column(String, ForeignKey("installments.id"))
@@ -90,11 +111,16 @@ class Charge(Base):
     installment = relationship("Installment", back_populates="charges")
     installment_order = relationship("InstallmentOrder", back_populates="charges")
 
+    __table_args__ = (
+        Index("ix_charges_customer_created", "customer_id", "created_at"),
+    )
+
 class WebhookLog(Base):
     __tablename__ = "webhook_logs"
     
-    id = Column(String, primary_key=True, default=generate_uuid)
+    id = Column(String, primary_key=True, server_default=gen_random_uuid())
     event_type = Column(String, nullable=False)  # charge.succeeded, charge.failed
+    charge_id = Column(String, index=True)  # charge the event is about
     payload = Column(JSON, nullable=False)
     status = Column(String, default="pending")  # pending, processed, failed
     processed_at = Column(DateTime(timezone=True))
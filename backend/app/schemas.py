@@ -1,15 +1,18 @@
-from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, condecimal
+from typing import Optional, List, Dict, Any, Generic, TypeVar
 from datetime import datetime
 from decimal import Decimal
 
+# Money amounts are exact to the cent; matches Numeric(18, 2) in the models
+Money = condecimal(max_digits=18, decimal_places=2)
+
 # Installment Order Schemas
 class InstallmentOrderCreate(BaseModel):
     customer_id: str = Field(..., description="Customer ID")
-    amount: float = Field(..., gt=0, description="Total order amount")
+    amount: Money = Field(..., gt=0, description="Total order amount")
     currency: str = Field(default="USD", description="Currency code")
     installment_count: int = Field(..., gt=0, le=24, description="Number of installments")
-    installment_amount: Optional[float] = Field(None, description="Amount per installment")
+    installment_amount: Optional[Money] = Field(None, description="Amount per installment")
 
 class InstallmentOrderResponse(BaseModel):
     id: str
@@ -22,8 +25,7 @@ class InstallmentOrderResponse(BaseModel):
     created_at: datetime
     updated_at: Optional[datetime]
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Installment Schemas
 class InstallmentResponse(BaseModel):
@@ -36,8 +38,7 @@ class InstallmentResponse(BaseModel):
     created_at: datetime
     updated_at: Optional[datetime]
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Wallet Schemas
 class WalletCreate(BaseModel):
@@ -53,8 +54,7 @@ class WalletResponse(BaseModel):
     created_at: datetime
     updated_at: Optional[datetime]
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 class WalletLedgerResponse(BaseModel):
     id: str
@@ -67,13 +67,12 @@ class WalletLedgerResponse(BaseModel):
     balance_after: float
     created_at: datetime
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Charge Schemas
 class ChargeCreate(BaseModel):
     customer_id: str = Field(..., description="Customer ID")
-    amount: float = Field(..., gt=0, description="Charge amount")
+    amount: Money = Field(..., gt=0, description="Charge amount")
     currency: str = Field(default="USD", description="Currency code")
     installment_id: Optional[str] = Field(None, description="Installment ID if charging for installment")
     installment_order_id: Optional[str] = Field(None, description="Installment order ID")
@@ -93,8 +92,7 @@ class ChargeResponse(BaseModel):
     created_at: datetime
     updated_at: Optional[datetime]
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Webhook Schemas
 class WebhookEvent(BaseModel):
@@ -115,8 +113,7 @@ class WebhookLogResponse(BaseModel):
     error_message: Optional[str]
     created_at: datetime
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # API Response Schemas
 class APIResponse(BaseModel):
@@ -124,9 +121,34 @@ class APIResponse(BaseModel):
     message: str
     data: Optional[Any] = None
 
-class PaginatedResponse(BaseModel):
-    items: List[Any]
+T = TypeVar("T")
+
+class PaginatedResponse(BaseModel, Generic[T]):
+    items: List[T]
     total: int
     page: int
     size: int
     pages: int
+
+    @classmethod
+    def from_page(cls, items: List[Any], total: int, skip: int, limit: int):
+        """
+        Build a page from an offset/limit slice and the total row count
+        """
+        size = max(limit, 1)
+        return cls.model_validate(
+            {
+                "items": items,
+                "total": total,
+                "page": skip // size + 1,
+                "size": limit,
+                "pages": -(-total // size)
+            },
+            from_attributes=True
+        )
+
+def dump_list(adapter: TypeAdapter, items: List[Any]) -> bytes:
+    """
+    Serialize ORM rows straight to JSON bytes, skipping the intermediate dict dump
+    """
+    return adapter.dump_json(adapter.validate_python(items, from_attributes=True))
@@ -1,266 +1,538 @@
-from celery import Celery
-from celery.schedules import crontab
+from celery import Celery, group
+from celery.utils.log import get_task_logger
+from celery.signals import task_postrun, worker_process_init, worker_process_shutdown
+import asyncio
+import functools
 import os
 from dotenv import load_dotenv
 import stripe
 import httpx
+import orjson
+import redis
+import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
+from typing import Union
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, scoped_session
 
-from app.database import SessionLocal
-from app import crud, models, schemas
+from app.database import SessionLocal, engine
+from app import cache, crud, models
 
 load_dotenv()
 
-# Celery configuration
-CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://redis:6379/0")
-CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://redis:6379/0")
-
-celery_app = Celery(
-    "payments_api",
-    broker=CELERY_BROKER_URL,
-    backend=CELERY_RESULT_BACKEND,
-    include=["app.celery_tasks"]
-)
+celery_app = Celery("payments_api")
+celery_app.config_from_object("app.celery_config")
 
 celery_app.conf.update(
-    task_serializer="json",
-    accept_content=["json"],
-    result_serializer="json",
-    timezone="UTC",
-    enable_utc=True,
+    # Tasks are I/O bound (Stripe, DB, webhooks): a worker only reserves the
+    # task it is running, and acks it once done so a crash re-queues it.
+    # Run workers with -Ofair so tasks go to idle processes.
+    worker_prefetch_multiplier=int(os.getenv("CELERY_PREFETCH_MULTIPLIER", "1")),
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    worker_max_tasks_per_child=500,
 )
 
 # Stripe configuration
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+if os.getenv("STRIPE_API_VERSION"):
+    stripe.api_version = os.getenv("STRIPE_API_VERSION")
+STRIPE_POOL_SIZE = int(os.getenv("STRIPE_POOL_SIZE", "20"))
 
-def get_db():
-    db = SessionLocal()
+def _stripe_http_client() -> stripe.RequestsClient:
+    """
+    Requests-based Stripe client over a pooled session, so connections are
+    kept alive across charges
+    """
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=STRIPE_POOL_SIZE, pool_maxsize=STRIPE_POOL_SIZE))
+    return stripe.RequestsClient(timeout=10, session=session)
+
+stripe.default_http_client = _stripe_http_client()
+
+# Fixed shape of the metadata attached to every Stripe charge
+_STRIPE_META_KEYS = ("charge_id", "installment_id", "installment_order_id")
+
+@worker_process_init.connect
+def init_stripe_client(**kwargs):
+    # Each forked worker gets its own pool rather than sockets from the parent
+    stripe.default_http_client = _stripe_http_client()
+
+# Webhook deliveries run on one event loop per worker process with one pooled
+# AsyncClient, so keep-alive connections are reused across tasks and URLs.
+# Both are created lazily in the worker process, never in the pre-fork parent.
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "10"))
+
+_webhook_loop = None
+_webhook_client = None
+
+@functools.lru_cache(maxsize=1)
+def _webhook_urls() -> tuple:
+    """
+    Configured webhook URLs, parsed once; call _webhook_urls.cache_clear()
+    to pick up a changed WEBHOOK_URLS
+    """
+    return tuple(url.strip() for url in os.getenv("WEBHOOK_URLS", "").split(",") if url.strip())
+
+def _webhook_runtime():
+    global _webhook_loop, _webhook_client
+    if _webhook_loop is None:
+        _webhook_loop = asyncio.new_event_loop()
+        _webhook_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(5.0, connect=2.0),
+            limits=httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=30.0),
+            headers={"Content-Type": "application/json"}
+        )
+    return _webhook_loop, _webhook_client
+
+async def _deliver_all(client: httpx.AsyncClient, body: bytes, urls: tuple) -> list:
+    """
+    POST the serialized payload to every URL concurrently; returns a response
+    or the raised exception per URL, in order
+    """
+    semaphore = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
+    
+    async def deliver(url):
+        async with semaphore:
+            return await client.post(url, content=body)
+    
+    tasks = [asyncio.create_task(deliver(url)) for url in urls]
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+# Per-URL circuit breaker shared by all workers through Redis: after
+# WEBHOOK_BREAKER_THRESHOLD consecutive failures a URL is skipped for
+# WEBHOOK_BREAKER_COOLDOWN seconds, then gets one more try (half-open); a
+# failed try reopens it straight away, a success closes it
+WEBHOOK_BREAKER_THRESHOLD = int(os.getenv("WEBHOOK_BREAKER_THRESHOLD", "5"))
+WEBHOOK_BREAKER_COOLDOWN = int(os.getenv("WEBHOOK_BREAKER_COOLDOWN", "60"))
+
+def _breaker_key(url: str) -> str:
+    return f"wh:breaker:{url}"
+
+def _open_circuits(urls: tuple) -> set:
+    """
+    URLs whose breaker is open; if Redis is unreachable every URL is tried
+    """
+    if not urls or not cache.available():
+        return set()
     try:
-        return db
-    finally:
-        db.close()
+        open_flags = cache.redis_client.mget([_breaker_key(url) + ":open" for url in urls])
+    except redis.RedisError:
+        cache.mark_unavailable()
+        return set()
+    return {url for url, flag in zip(urls, open_flags) if flag}
 
-@celery_app.task
+def _record_deliveries(outcomes: dict):
+    """
+    Update the breakers from a {url: delivered} map
+    """
+    if not cache.available():
+        return
+    failed = [url for url, delivered in outcomes.items() if not delivered]
+    try:
+        pipe = cache.redis_client.pipeline(transaction=False)
+        for url, delivered in outcomes.items():
+            if delivered:
+                pipe.delete(_breaker_key(url), _breaker_key(url) + ":open")
+        for url in failed:
+            pipe.incr(_breaker_key(url))
+            pipe.expire(_breaker_key(url), WEBHOOK_BREAKER_COOLDOWN * 10)
+        results = pipe.execute()
+        
+        failure_counts = results[len(results) - 2 * len(failed)::2]
+        tripped = [url for url, failures in zip(failed, failure_counts) if failures >= WEBHOOK_BREAKER_THRESHOLD]
+        if tripped:
+            pipe = cache.redis_client.pipeline(transaction=False)
+            for url in tripped:
+                pipe.set(_breaker_key(url) + ":open", 1, ex=WEBHOOK_BREAKER_COOLDOWN)
+            pipe.execute()
+    except redis.RedisError:
+        cache.mark_unavailable()
+
+@worker_process_shutdown.connect
+def close_webhook_client(**kwargs):
+    if _webhook_loop is not None:
+        _webhook_loop.run_until_complete(_webhook_client.aclose())
+        _webhook_loop.close()
+
+# One session per worker process, reused across tasks and reset after each
+WorkerSession = scoped_session(SessionLocal)
+
+@worker_process_init.connect
+def init_db_session(**kwargs):
+    # Pooled connections inherited from the parent must not be shared after fork
+    engine.dispose(close=False)
+    WorkerSession()
+
+@task_postrun.connect
+def remove_db_session(**kwargs):
+    WorkerSession.remove()
+
+def get_db():
+    return WorkerSession()
+
+logger = get_task_logger(__name__)
+
+# Transient failures (Stripe unreachable, dropped database connection) are
+# retried by Celery with jittered exponential backoff; any other exception
+# fails the task and is logged by the worker. Webhook transport errors never
+# reach here, they are recorded per URL on the webhook log.
+RETRY_POLICY = dict(
+    autoretry_for=(stripe.error.APIConnectionError, OperationalError),
+    retry_backoff=True,
+    retry_jitter=True,
+    max_retries=5,
+)
+
+@celery_app.task(**RETRY_POLICY)
 def schedule_installment_charge(installment_id: str, due_date: str):
     """
     Schedule a charge for an installment
     """
     db = get_db()
     try:
-        # Get the installment
-        installments = crud.get_installments_by_order(db, installment_id)
-        if not installments:
-            return {"error": "Installment not found"}
-        
-        installment = installments[0]
+        # Claim the installment and create its charge; retries and duplicate
+        # deliveries (e.g. ETA redelivery by the broker) find it already
+        # processing and stop here
+        charge_id = crud.claim_installment(db, installment_id)
+        if not charge_id:
+            return {"error": "Installment not found, already being charged or not chargeable"}
         
-        # Create a charge for this installment
-        charge_data = schemas.ChargeCreate(
-            customer_id=installment.order.customer_id,
-            amount=installment.amount,
-            currency=installment.order.currency,
-            installment_id=installment.id,
-            installment_order_id=installment.order_id
-        )
-        
-        charge = crud.create_charge(db, charge_data)
+        # Process the charge, then deliver its webhook in a separate task so
+        # process_charge acks and frees its slot as soon as the charge is done
+        (process_charge.s(charge_id) | send_charge_webhooks.s()).delay()
         
-        # Process the charge
-        process_charge.delay(charge.id)
-        
-        return {"success": True, "charge_id": charge.id}
+        return {"success": True, "charge_id": charge_id}
     
-    except Exception as e:
-        return {"error": str(e)}
+    finally:
+        db.close()
+
+@celery_app.task(bind=True, **RETRY_POLICY)
+def process_charge(self, charge_id: str):
+    """
+    Process a charge using wallet first, then external payment.
+
+    A webhook still to be delivered comes back in the result as
+    webhook_event/webhook_payload for send_charge_webhooks to send.
+    """
+    db = get_db()
+    try:
+        return _process_charge(db, charge_id, final_attempt=self.request.retries >= self.max_retries)
     finally:
         db.close()
 
 @celery_app.task
-def process_charge(charge_id: str):
+def process_charge_chunk(charge_ids: list) -> list:
     """
-    Process a charge using wallet first, then external payment
+    Process a chunk of the drainer's charges one after another.
+
+    A charge that raises does not stop the chunk: it is handed to a
+    process_charge task of its own, where the retry policy applies, and the
+    rest of the chunk carries on. Returns the results for send_charge_webhooks.
     """
     db = get_db()
     try:
-        charge = crud.get_charge(db, charge_id)
-        if not charge:
-            return {"error": "Charge not found"}
+        results = []
+        for charge_id in charge_ids:
+            try:
+                results.append(_process_charge(db, charge_id, final_attempt=False))
+            except Exception as e:
+                logger.warning("Charge %s failed in a chunk, retrying it on its own: %s", charge_id, e)
+                (process_charge.s(charge_id) | send_charge_webhooks.s()).apply_async(countdown=10)
+        return results
+    finally:
+        db.close()
 
-        customer_id = str(charge.customer_id)
-        charge_amount = float(charge.amount)
-        charge_currency = str(charge.currency)
-        charge_installment_id = str(charge.installment_id) if charge.installment_id is not None else None
-        charge_installment_order_id = str(charge.installment_order_id) if charge.installment_order_id is not None else None
+def _process_charge(db: Session, charge_id: str, final_attempt: bool) -> dict:
+    """
+    Charge body shared by process_charge and process_charge_chunk. Transient
+    errors are raised for a retry, except on the final attempt, where a
+    Stripe connection error leaves the charge in needs_review, as does any
+    error after money was taken.
+    """
+    # Claim the charge first: a retry or redelivery of a charge that has
+    # already taken money finds it processing (or settled) and stops here
+    charge = crud.claim_charge(db, charge_id)
+    if not charge:
+        return {"error": "Charge not found or already processed"}
 
+    customer_id = str(charge.customer_id)
+    charge_amount = charge.amount
+    charge_currency = str(charge.currency)
+    charge_installment_id = str(charge.installment_id) if charge.installment_id is not None else None
+    charge_installment_order_id = str(charge.installment_order_id) if charge.installment_order_id is not None else None
+
+    # Whether money has been taken for this charge and not given back;
+    # until it has, any error hands the charge back for a retry
+    money_moved = False
+    external_charge_id = None
+    try:
         wallet = crud.get_wallet(db, customer_id)
         remaining_amount = charge_amount
+        wallet_debited = 0
 
         if wallet and wallet.balance > 0:
             wallet_id = str(wallet.id)
-            wallet_balance = float(wallet.balance)
+            wallet_balance = wallet.balance
 
             if wallet_balance >= charge_amount:
-                # Wallet has enough balance to cover the entire charge
-                crud.update_wallet_balance(
-                    db, wallet_id, charge_amount, "debit",
-                    f"Payment for charge {charge_id}", charge_id
-                )
-                crud.update_charge_status(db, charge_id, "succeeded", "wallet")
-                send_webhook_event.delay("charge.succeeded", charge_id)
-                return {"success": True, "payment_method": "wallet"}
+                # Wallet has enough balance to cover the entire charge: debit
+                # and settle in one transaction. The debit is conditional, so
+                # if the balance was spent meanwhile we fall through to the
+                # external payment.
+                charge = crud.pay_charge_from_wallet(db, charge_id, wallet_id, charge_amount)
+                if charge:
+                    money_moved = True
+                    return {
+                        "success": True,
+                        "payment_method": "wallet",
+                        "webhook_event": "charge.succeeded",
+                        "webhook_payload": build_webhook_payload("charge.succeeded", charge)
+                    }
             else:
                 # Wallet has partial balance
-                remaining_amount = charge_amount - wallet_balance
-                crud.update_wallet_balance(
+                if crud.update_wallet_balance(
                     db, wallet_id, wallet_balance, "debit",
                     f"Partial payment for charge {charge_id}", charge_id
-                )
+                ):
+                    money_moved = True
+                    wallet_debited = wallet_balance
+                    remaining_amount = charge_amount - wallet_balance
         
         # Fallback to external payment (Stripe) for the remaining amount
         try:
             stripe_charge = stripe.Charge.create(
                 amount=int(remaining_amount * 100),
-                currency=charge_currency.lower(),
+                # Stored lower-case when the charge is created
+                currency=charge_currency,
                 customer=customer_id,
                 description=f"Installment payment - Charge {charge_id}",
-                metadata={
-                    "charge_id": charge_id,
-                    "installment_id": charge_installment_id,
-                    "installment_order_id": charge_installment_order_id
-                }
+                # Stripe dedupes retries of the same charge (acks_late redelivery,
+                # network errors), so a charge is never billed twice
+                idempotency_key=f"charge-{charge_id}",
+                metadata=dict(zip(_STRIPE_META_KEYS, (charge_id, charge_installment_id, charge_installment_order_id)))
             )
-            crud.update_charge_status(
+            money_moved = True
+            external_charge_id = stripe_charge.id
+            charge = crud.settle_charge(
                 db, charge_id, "succeeded", "external", stripe_charge.id
             )
-            send_webhook_event.delay("charge.succeeded", charge_id)
-            return {"success": True, "payment_method": "external", "stripe_charge_id": stripe_charge.id}
+            return {
+                "success": True,
+                "payment_method": "external",
+                "stripe_charge_id": stripe_charge.id,
+                "webhook_event": "charge.succeeded",
+                "webhook_payload": build_webhook_payload("charge.succeeded", charge)
+            }
 
         except stripe.error.StripeError as e:
             # If external payment fails, refund the wallet if it was used
-            if wallet and float(wallet.balance) < charge_amount:
-                wallet_id = str(wallet.id)
-                wallet_balance = float(wallet.balance)
+            if wallet_debited:
                 crud.update_wallet_balance(
-                    db, wallet_id, wallet_balance, "credit",
+                    db, str(wallet.id), wallet_debited, "credit",
                     f"Refund for failed charge {charge_id}", charge_id
                 )
-            crud.update_charge_status(db, charge_id, "failed", "external")
-            send_webhook_event.delay("charge.failed", charge_id)
-            return {"error": str(e), "payment_method": "external"}
+                money_moved = False
+            if isinstance(e, stripe.error.APIConnectionError):
+                # Stripe unreachable: let autoretry try again (the idempotency
+                # key keeps it from billing twice) until retries run out
+                if not final_attempt:
+                    raise
+                # Stripe may still have captured the charge; leave it for
+                # reconciliation rather than reporting it failed
+                logger.error("Charge %s outcome unknown, needs review: %s", charge_id, e)
+                crud.settle_charge(db, charge_id, "needs_review", "external")
+                return {"error": str(e), "payment_method": "external", "needs_review": True}
+            logger.warning("Charge %s failed: %s", charge_id, e)
+            charge = crud.settle_charge(db, charge_id, "failed", "external")
+            return {
+                "error": str(e),
+                "payment_method": "external",
+                "webhook_event": "charge.failed",
+                "webhook_payload": build_webhook_payload("charge.failed", charge)
+            }
+
+    except Exception:
+        db.rollback()
+        if money_moved:
+            # Not handed back, so no retry can take the money again; park the
+            # charge and its installment for reconciliation
+            logger.exception("Charge %s failed after taking payment, needs review", charge_id)
+            crud.settle_charge(db, charge_id, "needs_review", external_charge_id=external_charge_id)
+        else:
+            crud.release_charge(db, charge_id)
+        raise
+
+def build_webhook_payload(event_type: str, charge: models.Charge) -> dict:
+    """
+    Webhook payload for a charge event (JSON-serializable)
+    """
+    return {
+        "event_type": event_type,
+        "charge_id": charge.id,
+        "customer_id": charge.customer_id,
+        "amount": float(charge.amount),
+        "currency": charge.currency,
+        "status": charge.status,
+        "payment_method": charge.payment_method,
+        "external_charge_id": charge.external_charge_id,
+        "split_instructions": charge.split_instructions,
+        "created_at": charge.created_at.isoformat(),
+        "metadata": {
+            "installment_id": charge.installment_id,
+            "installment_order_id": charge.installment_order_id
+        }
+    }
+
+def _dispatch_webhook(db: Session, event_type: str, webhook_payload: dict) -> str:
+    """
+    Log a webhook event and deliver it to every configured URL; returns the
+    webhook log id
+    """
+    webhook_log = crud.create_webhook_log(db, event_type, webhook_payload)
+    
+    # Send to webhook URLs (configured in environment), all at once, skipping
+    # any whose circuit is open
+    webhook_urls = _webhook_urls()
+    open_urls = _open_circuits(webhook_urls)
+    target_urls = tuple(url for url in webhook_urls if url not in open_urls)
+    loop, client = _webhook_runtime()
+    # Serialize once for all URLs; the client sends the JSON content type
+    body = orjson.dumps(webhook_payload)
+    responses = loop.run_until_complete(_deliver_all(client, body, target_urls))
+    
+    errors = [f"{url}: circuit open" for url in webhook_urls if url in open_urls]
+    outcomes = {}
+    for url, response in zip(target_urls, responses):
+        if isinstance(response, Exception):
+            errors.append(f"{url}: {response}")
+        elif response.status_code != 200:
+            errors.append(f"{url}: HTTP {response.status_code}: {response.text}")
+        outcomes[url] = not isinstance(response, Exception) and response.status_code == 200
+    _record_deliveries(outcomes)
+    
+    # Record the outcome of the whole fan-out with a single UPDATE
+    if webhook_urls:
+        if errors:
+            crud.update_webhook_log_status(db, webhook_log.id, "failed", "; ".join(errors))
+        else:
+            crud.update_webhook_log_status(db, webhook_log.id, "processed")
+    
+    return webhook_log.id
+
+@celery_app.task(**RETRY_POLICY)
+def send_webhook_event(event_type: str, charge_payload: Union[dict, str]):
+    """
+    Send webhook event to configured webhook URLs.
+
+    Takes the payload built by the producing task; a charge id is still
+    accepted from older callers and looked up in the database.
+    """
+    db = get_db()
+    try:
+        if isinstance(charge_payload, dict):
+            webhook_payload = charge_payload
+        else:
+            charge = crud.get_charge(db, charge_payload)
+            if not charge:
+                return {"error": "Charge not found"}
+            webhook_payload = build_webhook_payload(event_type, charge)
+        
+        webhook_log_id = _dispatch_webhook(db, event_type, webhook_payload)
+        return {"success": True, "webhook_log_id": webhook_log_id}
+    
+    finally:
+        db.close()
 
-    except Exception as e:
-        return {"error": str(e)}
+@celery_app.task(**RETRY_POLICY)
+def send_charge_webhooks(results: Union[dict, list]):
+    """
+    Callback for process_charge: deliver the webhook carried by its result,
+    or by each result of a chunk of charges
+    """
+    if isinstance(results, dict):
+        results = [results]
+    results = [result for result in results if result.get("webhook_event")]
+    
+    db = get_db()
+    try:
+        # A retry after a partial run must not send the webhooks that already
+        # went out; skip every event that has a log
+        logged = crud.get_logged_webhook_events(
+            db, [result["webhook_payload"]["charge_id"] for result in results]
+        )
+        webhook_log_ids = [
+            _dispatch_webhook(db, result["webhook_event"], result["webhook_payload"])
+            for result in results
+            if (result["webhook_payload"]["charge_id"], result["webhook_event"]) not in logged
+        ]
+        return {"success": True, "webhook_log_ids": webhook_log_ids}
+    
     finally:
         db.close()
 
-@celery_app.task
-def send_webhook_event(event_type: str, charge_id: str):
+def charge_due_installments(db: Session, batch: int, concurrency: int) -> int:
+    """
+    Claim one batch of due installments together with their charges, and fan
+    the charges out over at most `concurrency` worker tasks, each followed by
+    one task delivering that chunk's webhooks
+    """
+    # Most runs find nothing due; skip the locking claim entirely then
+    if not crud.has_due_installments(db):
+        return 0
+    
+    charge_ids = crud.claim_due_installments(db, batch)
+    
+    if charge_ids:
+        chunk_size = -(-len(charge_ids) // concurrency)
+        group(
+            process_charge_chunk.s(charge_ids[i:i + chunk_size]) | send_charge_webhooks.s()
+            for i in range(0, len(charge_ids), chunk_size)
+        ).apply_async()
+    
+    return len(charge_ids)
+
+@celery_app.task(**RETRY_POLICY)
+def drain_due_installments(concurrency: int = 16, batch: int = 500):
     """
-    Send webhook event to configured webhook URLs
+    Charge one bounded batch of due installments (periodic task)
     """
     db = get_db()
     try:
-        charge = crud.get_charge(db, charge_id)
-        if not charge:
-            return {"error": "Charge not found"}
-        
-        # Create webhook payload
-        webhook_payload = {
-            "event_type": event_type,
-            "charge_id": charge.id,
-            "customer_id": charge.customer_id,
-            "amount": charge.amount,
-            "currency": charge.currency,
-            "status": charge.status,
-            "payment_method": charge.payment_method,
-            "external_charge_id": charge.external_charge_id,
-            "split_instructions": charge.split_instructions,
-            "created_at": charge.created_at.isoformat(),
-            "metadata": {
-                "installment_id": charge.installment_id,
-                "installment_order_id": charge.installment_order_id
-            }
-        }
-        
-        # Log webhook event
-        webhook_log = crud.create_webhook_log(db, event_type, webhook_payload)
-        
-        # Send to webhook URLs (configured in environment)
-        webhook_urls = os.getenv("WEBHOOK_URLS", "").split(",")
-        
-        for url in webhook_urls:
-            if url.strip():
-                try:
-                    with httpx.Client(timeout=30.0) as client:
-                        response = client.post(
-                            url.strip(),
-                            json=webhook_payload,
-                            headers={"Content-Type": "application/json"}
-                        )
-                        
-                        if response.status_code == 200:
-                            crud.update_webhook_log_status(db, webhook_log.id, "processed")
-                        else:
-                            crud.update_webhook_log_status(
-                                db, 
-                                webhook_log.id, 
-                                "failed", 
-                                f"HTTP {response.status_code}: {response.text}"
-                            )
-                
-                except Exception as e:
-                    crud.update_webhook_log_status(
-                        db, 
-                        webhook_log.id, 
-                        "failed", 
-                        str(e)
-                    )
-        
-        return {"success": True, "webhook_log_id": webhook_log.id}
+        processed_count = charge_due_installments(db, batch, concurrency)
+        return {"success": True, "processed_count": processed_count}
     
-    except Exception as e:
-        return {"error": str(e)}
     finally:
         db.close()
 
-@celery_app.task
-def process_due_installments():
+@celery_app.task(**RETRY_POLICY)
+def process_due_installments(concurrency: int = 16, batch: int = 500):
     """
-    Process all due installments (scheduled task)
+    Process all due installments, batch by batch
     """
     db = get_db()
     try:
-        due_installments = crud.get_due_installments(db)
-        
-        for installment in due_installments:
-            # Create charge for due installment
-            charge_data = schemas.ChargeCreate(
-                customer_id=installment.order.customer_id,
-                amount=installment.amount,
-                currency=installment.order.currency,
-                installment_id=installment.id,
-                installment_order_id=installment.order_id
-            )
-            
-            charge = crud.create_charge(db, charge_data)
-            process_charge.delay(charge.id)
+        processed_count = 0
+        while True:
+            count = charge_due_installments(db, batch, concurrency)
+            processed_count += count
+            if count < batch:
+                break
         
-        return {"success": True, "processed_count": len(due_installments)}
+        return {"success": True, "processed_count": processed_count}
     
-    except Exception as e:
-        return {"error": str(e)}
     finally:
         db.close()
 
 # Schedule periodic tasks
 @celery_app.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
-    # Process due installments daily at 9 AM UTC
+    # Drain due installments every 30 seconds in bounded batches
     sender.add_periodic_task(
-        crontab(hour=9, minute=0),
-        process_due_installments.s(),
-        name="process-due-installments-daily"
+        30.0,
+        drain_due_installments.s(),
+        name="drain-due-installments"
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,40 @@
+-- Upgrade a database created before server-generated ids, Numeric money
+-- columns and the query indexes. create_all() only creates missing tables,
+-- so existing tables need this once:
+--
+--   psql "$DATABASE_URL" -f migrations/0001_server_ids_numeric_indexes.sql
+--
+-- Safe to run more than once. Requires PostgreSQL 13+ (gen_random_uuid).
+
+BEGIN;
+
+-- Primary keys are generated by the database
+ALTER TABLE installment_orders ALTER COLUMN id SET DEFAULT gen_random_uuid()::text;
+ALTER TABLE installments ALTER COLUMN id SET DEFAULT gen_random_uuid()::text;
+ALTER TABLE wallets ALTER COLUMN id SET DEFAULT gen_random_uuid()::text;
+ALTER TABLE wallet_ledger ALTER COLUMN id SET DEFAULT gen_random_uuid()::text;
+ALTER TABLE charges ALTER COLUMN id SET DEFAULT gen_random_uuid()::text;
+ALTER TABLE webhook_logs ALTER COLUMN id SET DEFAULT gen_random_uuid()::text;
+
+-- Money is stored as exact decimals
+ALTER TABLE installment_orders
+    ALTER COLUMN amount TYPE NUMERIC(18, 2) USING round(amount::numeric, 2),
+    ALTER COLUMN installment_amount TYPE NUMERIC(18, 2) USING round(installment_amount::numeric, 2);
+ALTER TABLE installments
+    ALTER COLUMN amount TYPE NUMERIC(18, 2) USING round(amount::numeric, 2);
+ALTER TABLE wallets
+    ALTER COLUMN balance TYPE NUMERIC(18, 2) USING round(balance::numeric, 2);
+ALTER TABLE wallet_ledger
+    ALTER COLUMN amount TYPE NUMERIC(18, 2) USING round(amount::numeric, 2),
+    ALTER COLUMN balance_before TYPE NUMERIC(18, 2) USING round(balance_before::numeric, 2),
+    ALTER COLUMN balance_after TYPE NUMERIC(18, 2) USING round(balance_after::numeric, 2);
+ALTER TABLE charges
+    ALTER COLUMN amount TYPE NUMERIC(18, 2) USING round(amount::numeric, 2);
+
+-- Indexes declared on the models
+CREATE INDEX IF NOT EXISTS ix_installments_status_due ON installments (status, due_date);
+CREATE INDEX IF NOT EXISTS ix_installments_order_id ON installments (order_id);
+CREATE INDEX IF NOT EXISTS ix_charges_customer_created ON charges (customer_id, created_at);
+CREATE INDEX IF NOT EXISTS ix_wallet_ledger_wallet_created ON wallet_ledger (wallet_id, created_at DESC);
+
+COMMIT;
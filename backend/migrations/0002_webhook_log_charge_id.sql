@@ -0,0 +1,14 @@
+-- Record which charge a webhook log is about, so a retried webhook callback
+-- can skip the events it already sent:
+--
+--   psql "$DATABASE_URL" -f migrations/0002_webhook_log_charge_id.sql
+--
+-- Safe to run more than once.
+
+BEGIN;
+
+ALTER TABLE webhook_logs ADD COLUMN IF NOT EXISTS charge_id VARCHAR;
+UPDATE webhook_logs SET charge_id = payload->>'charge_id' WHERE charge_id IS NULL;
+CREATE INDEX IF NOT EXISTS ix_webhook_logs_charge_id ON webhook_logs (charge_id);
+
+COMMIT;
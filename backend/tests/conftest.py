@@ -0,0 +1,43 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from app.main import app
+from app.database import get_db, Base
+
+# Shared-cache in-memory database: every connection sees the same data and
+# nothing is written to disk
+SQLALCHEMY_DATABASE_URL = "sqlite+pysqlite:///file:testdb?mode=memory&cache=shared&uri=true"
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False, "uri": True}
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def override_get_db():
+    try:
+        db = TestingSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+
+@pytest.fixture(autouse=True, scope="session")
+def test_db():
+    # The in-memory database lives as long as one connection stays open, so
+    # hold this one for the whole session
+    with engine.connect() as conn:
+        conn.execute(text("PRAGMA journal_mode=MEMORY"))
+        conn.execute(text("PRAGMA synchronous=OFF"))
+        Base.metadata.create_all(bind=conn)
+        conn.commit()
+        app.dependency_overrides[get_db] = override_get_db
+        yield
+        app.dependency_overrides.pop(get_db, None)
+
+
+@pytest.fixture(scope="session")
+def client(test_db):
+    with TestClient(app) as c:
+        yield c
@@ -1,36 +1,7 @@
 import pytest
-from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from app.main import app
-from app.database import get_db, Base
-from app.models import InstallmentOrder
-from app.schemas import InstallmentOrderCreate
+from app.api.endpoints import installments
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
-
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-
-Base.metadata.create_all(bind=engine)
-
-
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
-        yield db
-    finally:
-        db.close()
-
-
-app.dependency_overrides[get_db] = override_get_db
-
-client = TestClient(app)
-
-def test_create_installment_order():
+def test_create_installment_order(client):
     response = client.post(
         "/installments/orders",
         json={"customer_id": "test_customer", "amount": 1000, "installment_count": 10},
@@ -42,7 +13,7 @@ def test_create_installment_order():
     assert data["installment_count"] == 10
     assert "id" in data
 
-def test_get_installment_order():
+def test_get_installment_order(client):
     # First create an order
     response = client.post(
         "/installments/orders",
@@ -57,11 +28,11 @@ def test_get_installment_order():
     assert data["id"] == order_id
     assert data["customer_id"] == "test_customer_2"
 
-def test_get_nonexistent_order():
+def test_get_nonexistent_order(client):
     response = client.get("/installments/orders/nonexistent_id")
     assert response.status_code == 404
 
-def test_get_installments_for_order():
+def test_get_installments_for_order(client):
     # First create an order
     response = client.post(
         "/installments/orders",
@@ -76,4 +47,86 @@ def test_get_installments_for_order():
     assert len(data) == 12
     assert data[0]["order_id"] == order_id
     assert data[0]["installment_number"] == 1
-    assert data[0]["amount"] == 100 
\ No newline at end of file
+    assert data[0]["amount"] == 100 
+
+def test_process_installment_payment(client, monkeypatch):
+    dispatched = []
+    monkeypatch.setattr(
+        installments.schedule_installment_charge, "apply_async",
+        lambda *args, **kwargs: dispatched.append(kwargs)
+    )
+
+    response = client.post(
+        "/installments/orders",
+        json={"customer_id": "test_customer_4", "amount": 300, "installment_count": 3},
+    )
+    order_id = response.json()["id"]
+    installment = client.get(f"/installments/orders/{order_id}/installments").json()[0]
+
+    response = client.post(f"/installments/installments/{installment['id']}/process")
+    assert response.status_code == 200
+    assert response.json()["installment"]["id"] == installment["id"]
+    assert len(dispatched) == 1
+    assert dispatched[0]["kwargs"]["installment_id"] == installment["id"]
+    assert dispatched[0]["kwargs"]["due_date"].startswith(installment["due_date"][:19])
+
+def test_process_nonexistent_installment(client):
+    response = client.post("/installments/installments/nonexistent_id/process")
+    assert response.status_code == 404
+
+def test_installment_amount_must_match_total(client):
+    response = client.post(
+        "/installments/orders",
+        json={"customer_id": "test_customer_5", "amount": 1000, "installment_count": 3, "installment_amount": 300},
+    )
+    assert response.status_code == 400
+
+def test_last_installment_takes_rounding_remainder(client):
+    response = client.post(
+        "/installments/orders",
+        json={"customer_id": "test_customer_6", "amount": 1000, "installment_count": 3, "installment_amount": 333.33},
+    )
+    assert response.status_code == 200
+    order_id = response.json()["id"]
+
+    data = client.get(f"/installments/orders/{order_id}/installments").json()
+    assert [i["amount"] for i in data] == [333.33, 333.33, 333.34]
+
+def test_rounded_down_installment_amount_rejected(client):
+    response = client.post(
+        "/installments/orders",
+        json={"customer_id": "test_customer_7", "amount": 0.10, "installment_count": 24},
+    )
+    assert response.status_code == 400
+
+def test_negative_last_installment_rejected(client):
+    response = client.post(
+        "/installments/orders",
+        json={"customer_id": "test_customer_8", "amount": 0.01, "installment_count": 24, "installment_amount": 0.01},
+    )
+    assert response.status_code == 400
+
+def test_list_installment_orders_paginated(client):
+    for i in range(3):
+        client.post(
+            "/installments/orders",
+            json={"customer_id": "test_customer_page", "amount": 100, "installment_count": 1},
+        )
+
+    response = client.get("/installments/orders", params={"customer_id": "test_customer_page", "limit": 2})
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data["items"]) == 2
+    assert data["total"] == 3
+    assert data["pages"] == 2
+
+    # An empty page still reports the total
+    data = client.get("/installments/orders", params={"customer_id": "test_customer_page", "limit": 0}).json()
+    assert data["items"] == []
+    assert data["total"] == 3
+
+    response = client.get("/installments/orders", params={"customer_id": "test_customer_page", "skip": 4, "limit": 2})
+    data = response.json()
+    assert data["items"] == []
+    assert data["total"] == 3
+    assert data["page"] == 3
@@ -1,22 +1,28 @@
 import pytest
-from fastapi.testclient import TestClient
-from app.main import app
+from anyio import to_thread
+from app.main import API_THREADPOOL_SIZE
+from app import crud, models
+from datetime import datetime
+from tests.conftest import TestingSessionLocal
 
-client = TestClient(app)
-
-def test_health_check():
+def test_health_check(client):
     response = client.get("/health")
     assert response.status_code == 200
     assert response.json()["status"] == "healthy"
 
-def test_create_wallet():
+def test_threadpool_sized_by_lifespan(client):
+    tokens = client.portal.call(lambda: to_thread.current_default_thread_limiter().total_tokens)
+    assert tokens == API_THREADPOOL_SIZE
+    assert tokens > 40
+
+def test_create_wallet(client):
     data = {"customer_id": "testuser", "currency": "USD"}
     response = client.post("/wallets", json=data)
     assert response.status_code == 200
     assert response.json()["customer_id"] == "testuser"
     assert response.json()["currency"] == "USD"
 
-def test_create_installment_order():
+def test_create_installment_order(client):
     data = {
         "customer_id": "testuser2",
         "amount": 1000,
@@ -27,4 +33,51 @@ def test_create_installment_order():
     assert response.status_code == 200
     assert response.json()["customer_id"] == "testuser2"
     assert response.json()["amount"] == 1000
-    assert response.json()["installment_count"] == 5
\ No newline at end of file
+    assert response.json()["installment_count"] == 5
+
+def test_credit_wallet(client):
+    client.post("/wallets", json={"customer_id": "testuser3", "currency": "USD"})
+    response = client.post("/wallets/testuser3/credit", params={"amount": 25.5})
+    assert response.status_code == 200
+    assert response.json()["new_balance"] == 25.5
+
+    response = client.get("/wallets/testuser3/ledger")
+    assert response.status_code == 200
+    entry = response.json()[0]
+    assert entry["balance_before"] == 0
+    assert entry["balance_after"] == 25.5
+
+def test_wallet_ledger_keyset_pagination(client):
+    client.post("/wallets", json={"customer_id": "testuser4", "currency": "USD"})
+    client.post("/wallets/testuser4/credit", params={"amount": 10})
+
+    response = client.get("/wallets/testuser4/ledger", params={"limit": 1})
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+
+    response = client.get("/wallets/testuser4/ledger", params={"before": "2000-01-01T00:00:00"})
+    assert response.status_code == 200
+    assert response.json() == []
+
+def test_wallet_ledger_pages_through_tied_timestamps(client):
+    client.post("/wallets", json={"customer_id": "testuser5", "currency": "USD"})
+    for amount in (1, 2, 3):
+        client.post("/wallets/testuser5/credit", params={"amount": amount})
+    # Entries written in one transaction share a timestamp
+    db = TestingSessionLocal()
+    wallet = crud.get_wallet(db, "testuser5")
+    db.query(models.WalletLedger).filter(models.WalletLedger.wallet_id == wallet.id).update(
+        {"created_at": datetime(2024, 1, 1, 12, 0, 0)}
+    )
+    db.commit()
+    db.close()
+
+    first = client.get("/wallets/testuser5/ledger", params={"limit": 2}).json()
+    last = first[-1]
+    second = client.get(
+        "/wallets/testuser5/ledger",
+        params={"limit": 2, "before": last["created_at"], "before_id": last["id"]},
+    ).json()
+
+    assert len(first) == 2 and len(second) == 1
+    assert sorted(entry["amount"] for entry in first + second) == [1, 2, 3]
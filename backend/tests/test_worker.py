@@ -0,0 +1,200 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+
+import celery_worker
+from app import cache, crud, database, models, schemas
+from tests.conftest import engine, TestingSessionLocal
+
+URL_A = "https://a.example/hook"
+URL_B = "https://b.example/hook"
+URL_C = "https://c.example/hook"
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(cache, "redis_client", client)
+    monkeypatch.setattr(cache, "_unavailable_until", 0.0)
+    monkeypatch.setattr(celery_worker, "WEBHOOK_BREAKER_THRESHOLD", 3)
+    return client
+
+def fail(*urls):
+    celery_worker._record_deliveries({url: False for url in urls})
+
+def test_breaker_opens_at_threshold(fake_redis):
+    fail(URL_A, URL_B)
+    assert celery_worker._open_circuits((URL_A, URL_B)) == set()
+    fail(URL_A, URL_B)
+    assert celery_worker._open_circuits((URL_A, URL_B)) == set()
+    fail(URL_A, URL_B)
+    assert celery_worker._open_circuits((URL_A, URL_B)) == {URL_A, URL_B}
+
+def test_breaker_counts_each_failed_url_in_a_mixed_batch(fake_redis):
+    # Successes are queued before the failures in the same pipeline, so the
+    # failure counts must be read from the tail of its results
+    fail(URL_B)
+    fail(URL_B)
+    celery_worker._record_deliveries({URL_A: False, URL_B: False, URL_C: True})
+    assert celery_worker._open_circuits((URL_A, URL_B, URL_C)) == {URL_B}
+    assert int(fake_redis.get(celery_worker._breaker_key(URL_A))) == 1
+    assert int(fake_redis.get(celery_worker._breaker_key(URL_B))) == 3
+
+def test_breaker_half_open(fake_redis):
+    for _ in range(3):
+        fail(URL_A)
+    assert celery_worker._open_circuits((URL_A,)) == {URL_A}
+
+    # Cooldown over: the URL gets one try, and a failure reopens at once
+    fake_redis.delete(celery_worker._breaker_key(URL_A) + ":open")
+    assert celery_worker._open_circuits((URL_A,)) == set()
+    fail(URL_A)
+    assert celery_worker._open_circuits((URL_A,)) == {URL_A}
+
+    # A success after the next cooldown closes it and resets the count
+    fake_redis.delete(celery_worker._breaker_key(URL_A) + ":open")
+    celery_worker._record_deliveries({URL_A: True})
+    assert celery_worker._open_circuits((URL_A,)) == set()
+    fail(URL_A)
+    assert celery_worker._open_circuits((URL_A,)) == set()
+
+def test_breaker_skipped_while_redis_unavailable(fake_redis):
+    fake_redis.set(celery_worker._breaker_key(URL_A) + ":open", 1)
+    cache.mark_unavailable()
+
+    assert celery_worker._open_circuits((URL_A,)) == set()
+    for _ in range(3):
+        fail(URL_B)
+    assert fake_redis.get(celery_worker._breaker_key(URL_B)) is None
+
+def test_breaker_marks_redis_unavailable_on_error(fake_redis, monkeypatch):
+    server = fakeredis.FakeServer()
+    server.connected = False
+    monkeypatch.setattr(cache, "redis_client", fakeredis.FakeRedis(server=server))
+
+    assert celery_worker._open_circuits((URL_A,)) == set()
+    assert not cache.available()
+
+def test_claim_skips_unchargeable_installments():
+    db = TestingSessionLocal()
+    try:
+        order = crud.create_installment_order(db, schemas.InstallmentOrderCreate(
+            customer_id="claim_customer", amount=200, installment_count=2
+        ))
+        bad, good = crud.get_installments_by_order(db, order.id)
+        bad.amount = Decimal("0")
+        for installment in (bad, good):
+            installment.due_date = datetime.utcnow() - timedelta(days=1)
+        db.commit()
+
+        charge_ids = crud.claim_due_installments(db)
+
+        assert [crud.get_charge(db, charge_id).installment_id for charge_id in charge_ids] == [good.id]
+        db.expire_all()
+        assert (bad.status, good.status) == ("failed", "processing")
+
+    finally:
+        db.close()
+
+@pytest.fixture
+def eager_worker(fake_redis, monkeypatch):
+    # Run tasks inline against the test database
+    celery_worker.WorkerSession.remove()
+    celery_worker.WorkerSession.configure(bind=engine)
+    monkeypatch.setattr(celery_worker.celery_app.conf, "task_always_eager", True)
+    yield
+    celery_worker.WorkerSession.remove()
+    celery_worker.WorkerSession.configure(bind=database.engine)
+
+def test_drain_charges_due_installments_from_wallet(eager_worker):
+    db = TestingSessionLocal()
+    try:
+        order = crud.create_installment_order(db, schemas.InstallmentOrderCreate(
+            customer_id="drain_customer", amount=300, installment_count=3
+        ))
+        wallet = crud.create_wallet(db, schemas.WalletCreate(customer_id="drain_customer"))
+        crud.update_wallet_balance(db, wallet.id, Decimal("1000"), "credit")
+        db.query(models.Installment).filter(models.Installment.order_id == order.id).update(
+            {"due_date": datetime.utcnow() - timedelta(days=1)}
+        )
+        db.commit()
+
+        result = celery_worker.drain_due_installments.apply(kwargs={"concurrency": 2}).get()
+        assert result == {"success": True, "processed_count": 3}
+
+        db.expire_all()
+        installments = crud.get_installments_by_order(db, order.id)
+        assert [i.status for i in installments] == ["paid"] * 3
+        charges = db.query(models.Charge).filter(
+            models.Charge.installment_id.in_([i.id for i in installments])
+        ).all()
+        assert [(c.status, c.payment_method) for c in charges] == [("succeeded", "wallet")] * 3
+        logs = db.query(models.WebhookLog).filter(
+            models.WebhookLog.charge_id.in_([c.id for c in charges])
+        ).all()
+        assert sorted(log.event_type for log in logs) == ["charge.succeeded"] * 3
+        assert crud.get_wallet(db, "drain_customer").balance == Decimal("700")
+
+        # Nothing left due: the next run claims nothing
+        result = celery_worker.drain_due_installments.apply().get()
+        assert result == {"success": True, "processed_count": 0}
+
+    finally:
+        db.close()
+
+def _claimed_charge(db, customer_id):
+    order = crud.create_installment_order(db, schemas.InstallmentOrderCreate(
+        customer_id=customer_id, amount=100, installment_count=1
+    ))
+    installment = crud.get_installments_by_order(db, order.id)[0]
+    charge_id = crud.claim_installment(db, installment.id)
+    return charge_id, installment
+
+def test_unreachable_stripe_on_last_attempt_needs_review(monkeypatch):
+    def unreachable(**kwargs):
+        raise celery_worker.stripe.error.APIConnectionError("Connection reset")
+    monkeypatch.setattr(celery_worker.stripe.Charge, "create", unreachable)
+
+    db = TestingSessionLocal()
+    try:
+        charge_id, installment = _claimed_charge(db, "review_customer_1")
+
+        result = celery_worker._process_charge(db, charge_id, final_attempt=True)
+
+        assert result["needs_review"] and "webhook_event" not in result
+        db.expire_all()
+        assert crud.get_charge(db, charge_id).status == "needs_review"
+        assert installment.status == "needs_review"
+
+    finally:
+        db.close()
+
+def test_error_after_payment_needs_review(monkeypatch):
+    monkeypatch.setattr(
+        celery_worker.stripe.Charge, "create", lambda **kwargs: SimpleNamespace(id="ch_taken")
+    )
+    settle_charge = crud.settle_charge
+    def settle_fails_on_success(db, charge_id, status, *args, **kwargs):
+        if status == "succeeded":
+            raise RuntimeError("database went away")
+        return settle_charge(db, charge_id, status, *args, **kwargs)
+    monkeypatch.setattr(crud, "settle_charge", settle_fails_on_success)
+
+    db = TestingSessionLocal()
+    try:
+        charge_id, installment = _claimed_charge(db, "review_customer_2")
+
+        with pytest.raises(RuntimeError):
+            celery_worker._process_charge(db, charge_id, final_attempt=False)
+
+        db.expire_all()
+        charge = crud.get_charge(db, charge_id)
+        assert (charge.status, charge.external_charge_id) == ("needs_review", "ch_taken")
+        assert installment.status == "needs_review"
+        # A retry finds the charge settled and does not charge it again
+        assert "error" in celery_worker._process_charge(db, charge_id, final_attempt=False)
+
+    finally:
+        db.close()
@@ -1,11 +1,23 @@
-import json
+import logging
+import os
 from fastapi import FastAPI, Request, HTTPException
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict
 from typing import Any, Dict, Optional
 
-app = FastAPI()
+# Events are logged at debug level, so they cost a level check unless
+# WEBHOOK_DEBUG is set
+logger = logging.getLogger("webhooks")
+logger.setLevel(logging.INFO)
+if os.getenv("WEBHOOK_DEBUG"):
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.StreamHandler())
+
+app = FastAPI(default_response_class=ORJSONResponse)
 
 class WebhookPayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     event_type: str
     charge_id: str
     customer_id: str
@@ -24,17 +36,18 @@ async def webhook_listener(payload: WebhookPayload):
     """
     Listen for webhook events from the Payments API
     """
-    print(f"Received webhook event: {payload.event_type}")
+    logger.debug("Received webhook event: %s", payload.event_type)
     # Pydantic automatically validates the payload, so we can access attributes directly
-    print(payload.model_dump_json(indent=2))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s", payload.model_dump_json(indent=2))
 
     # Process the event based on its type
     if payload.event_type == "charge.succeeded":
         # Handle successful charge
-        print("Processing successful charge...")
+        logger.debug("Processing successful charge...")
     elif payload.event_type == "charge.failed":
         # Handle failed charge
-        print("Processing failed charge...")
+        logger.debug("Processing failed charge...")
 
     return {"status": "success"}
 